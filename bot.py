@@ -1,11 +1,17 @@
 # bot.py
 import os
+import re
 import time
+import asyncio
 import logging
+from collections import namedtuple
+from functools import lru_cache
+from operator import attrgetter
 from datetime import datetime, timezone
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 
-import requests
+import httpx
+import orjson
 from dotenv import load_dotenv
 from telegram import (
     InlineKeyboardButton,
@@ -13,6 +19,7 @@ from telegram import (
     Update,
 )
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     CallbackQueryHandler,
@@ -40,7 +47,10 @@ logger = logging.getLogger("okx_rate_bot")
 # Constants
 # -------------------------
 ALL_PAIRS_URL = "https://www.okx.com/priapi/v2/financial/market-lending-info?pageSize=2000&pageIndex=1"
-HISTORY_URL_TEMPLATE = "https://www.okx.com/priapi/v2/financial/market-lending-history?currencyId={}&pageSize=300&pageIndex=1"
+ASSET_URL_TEMPLATE = "https://www.okx.com/priapi/v2/financial/market-lending-info?currencyId={}&pageSize=20&pageIndex=1"
+# History detail shows the newest HISTORY_RECORDS hourly entries, so that's all we download
+HISTORY_RECORDS = 24
+HISTORY_URL_TEMPLATE = "https://www.okx.com/priapi/v2/financial/market-lending-history?currencyId={}&pageSize={}&pageIndex=1"
 
 CURRENCY_IDS = {
     "USDT": 7, "USDC": 283, "TON": 2054, "ZRO": 2425497, "APT": 2092, "BERA": 3197,
@@ -56,74 +66,287 @@ PAIRS_FILTER_INPUT = 2
 # Pagination
 PAGE_SIZE = 10
 
-# Simple cache to avoid hitting API too often (time in seconds)
+DAY_MS = 86_400_000
+
+# Parsed once per fetch so handlers never touch raw OKX JSON
+AssetView = namedtuple("AssetView", "name pre_pct est_pct date_ms hhmm dt_str")
+# C-level sort key (no Python call per element, unlike a lambda)
+_by_pre_pct = attrgetter("pre_pct")
+
+# Simple cache to avoid hitting API too often (ts are time.monotonic() seconds)
 _cache = {
-    "assets": {"ts": 0, "data": []},
+    # ts: last fetch or 304; version: bumped only when data changes (keys derived views)
+    "assets": {"ts": 0, "version": 0, "data": [], "by_name": {}, "tickers_sorted": [], "validators": {}},
+    "assets_error": {"ts": 0.0, "backoff": 0.0},  # last failed asset fetch; ts is 0 once one succeeds
+    "history": {},  # currency_id -> {"ts": ..., "data": [...]}
 }
 CACHE_TTL = 30  # seconds
+HISTORY_CACHE_TTL = 300  # seconds; OKX history is hourly
+# Background refresh runs well inside CACHE_TTL, so handlers normally never wait on OKX
+ASSET_REFRESH_INTERVAL = 20  # seconds
+# After a failed asset fetch, serve the last good data and back off (doubling, bounded)
+ERROR_BACKOFF_MIN = 5  # seconds
+ERROR_BACKOFF_MAX = 60  # seconds
+
+# Sorted views derived from _cache["assets"]; rebuilt only when its version changes
+_derived = {
+    "pairs": {"version": None, "rows": [], "tickers": []},
+    "history": {"version": None, "rows": []},
+}
+# Page keyboards built from the _derived views, keyed by (view, page); same version rule
+_kb_cache = {"version": None, "markups": {}}
+KB_CACHE_MAX = 256
+
+# One keep-alive async client for all OKX calls; created in post_init once the loop runs
+HTTP_HEADERS = {"User-Agent": "Mozilla/5.0", "Accept": "application/json"}
+_http: Optional[httpx.AsyncClient] = None
+# Transient OKX statuses retried with exponential backoff (connect errors are retried by the transport)
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+HTTP_RETRIES = 2
+RETRY_BACKOFF = 0.2  # seconds
+# Cap on in-flight OKX requests across all handlers and background work
+OKX_CONCURRENCY = 8
+_okx_sem: Optional[asyncio.Semaphore] = None  # created in post_init
+# After a 429/5xx every OKX request waits until this monotonic time (Retry-After, capped)
+OKX_MAX_COOLDOWN = 10  # seconds
+_okx_cooldown_until = 0.0
+_refresh_task: Optional[asyncio.Task] = None
+# Held while the asset list is being fetched; created in post_init
+_assets_lock: Optional[asyncio.Lock] = None
+# currency_id -> lock held while that currency's history is being fetched
+_history_locks: Dict[int, asyncio.Lock] = {}
+# ticker -> in-flight single-asset request; concurrent refreshes of a ticker await the same one
+_asset_inflight: Dict[str, asyncio.Task] = {}
+
+# Per-user Refresh debounce: (user_id, ticker) -> time of the last accepted press
+REFRESH_COOLDOWN = 2.0  # seconds
+REFRESH_COOLDOWN_PRUNE_AT = 1024  # entries; expired ones are dropped past this size
+_last_refresh: Dict[Tuple[int, str], float] = {}
+
+# Max concurrent OKX requests when warming the history cache in the background;
+# kept below OKX_CONCURRENCY so user-facing requests always have slots
+PREFETCH_CONCURRENCY = 4
+_prefetch_sem: Optional[asyncio.Semaphore] = None  # created in post_init, on the running loop
 
 # -------------------------
 # Helpers: API + formatting
 # -------------------------
-def fetch_assets(force: bool = False) -> List[Dict[str, Any]]:
-    """Fetch (and cache) market-lending-info list."""
-    now = time.time()
-    if not force and _cache["assets"]["data"] and (now - _cache["assets"]["ts"] < CACHE_TTL):
-        return _cache["assets"]["data"]
-
-    headers = {"User-Agent": "Mozilla/5.0", "Accept": "application/json"}
+def _retry_after(r: httpx.Response) -> Optional[float]:
+    """Positive Retry-After seconds; None if absent, an HTTP-date, or <= 0 (caller backs off)."""
     try:
-        logger.info("Fetching market-lending-info from OKX")
-        r = requests.get(ALL_PAIRS_URL, headers=headers, timeout=10)
+        seconds = float(r.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+    return seconds if seconds > 0 else None
+
+async def _send_after_cooldown(url: str, headers: Optional[Dict[str, str]]) -> httpx.Response:
+    # re-check after acquiring _okx_sem: a 429 may have started a cooldown while we queued
+    while True:
+        async with _okx_sem:
+            wait = _okx_cooldown_until - time.monotonic()
+            if wait <= 0:
+                return await _http.get(url, headers=headers)
+        await asyncio.sleep(wait)
+
+async def _get(url: str, headers: Optional[Dict[str, str]] = None) -> httpx.Response:
+    """GET with retries and the shared 429/5xx cooldown; raises on HTTP errors except 304."""
+    global _okx_cooldown_until
+    for attempt in range(HTTP_RETRIES + 1):
+        r = await _send_after_cooldown(url, headers)
+        if r.status_code not in RETRY_STATUSES:
+            break
+        delay = max(0.0, min(_retry_after(r) or RETRY_BACKOFF * 2 ** attempt, OKX_MAX_COOLDOWN))
+        _okx_cooldown_until = max(_okx_cooldown_until, time.monotonic() + delay)
+        logger.warning("OKX returned %s; pausing requests for %.1fs", r.status_code, delay)
+        if attempt == HTTP_RETRIES:
+            break
+    if r.status_code != 304:
         r.raise_for_status()
-        data = r.json()
-        items = data.get("data", {}).get("list", [])
-        if isinstance(items, dict):
-            items = [items]
+    return r
+
+def _parse_list(r: httpx.Response) -> List[Dict[str, Any]]:
+    data = orjson.loads(r.content)
+    items = data.get("data", {}).get("list", [])
+    if isinstance(items, dict):
+        items = [items]
+    return items
+
+async def _get_list(url: str) -> List[Dict[str, Any]]:
+    """GET an OKX priapi endpoint and return its data.list (raises on HTTP errors)."""
+    return _parse_list(await _get(url))
+
+def _validators(r: httpx.Response) -> Dict[str, str]:
+    """Conditional-request headers for revalidating the resource `r` came from."""
+    headers = {}
+    if r.headers.get("etag"):
+        headers["If-None-Match"] = r.headers["etag"]
+    if r.headers.get("last-modified"):
+        headers["If-Modified-Since"] = r.headers["last-modified"]
+    return headers
+
+def make_asset_view(a: Dict[str, Any]) -> AssetView:
+    ms = a.get("dateHour")
+    return AssetView(
+        name=(a.get("currencyName") or "").upper(),
+        pre_pct=safe_float(a.get("preRate", 0)) * 100,
+        est_pct=safe_float(a.get("estimatedRate", 0)) * 100,
+        date_ms=ms,
+        hhmm=ms_to_utc_time(ms) if ms else "N/A",
+        dt_str=ms_to_utc_dt(ms) if ms else "N/A",
+    )
+
+def _index_assets(assets: List[AssetView]) -> Dict[str, AssetView]:
+    """Map ticker -> asset view (entries without a name are skipped)."""
+    return {v.name: v for v in assets if v.name}
+
+def _assets_fresh() -> bool:
+    return bool(_cache["assets"]["data"]) and (time.monotonic() - _cache["assets"]["ts"] < CACHE_TTL)
+
+def _in_error_backoff() -> bool:
+    err = _cache["assets_error"]
+    return bool(err["ts"]) and time.monotonic() - err["ts"] < err["backoff"]
+
+async def fetch_assets(force: bool = False) -> List[AssetView]:
+    """Fetch (and cache) market-lending-info list; serves the last good data on errors."""
+    requested = time.monotonic()
+    if not force and (_assets_fresh() or _in_error_backoff()):
+        return _cache["assets"]["data"]
+
+    async with _assets_lock:
+        # someone else may have refreshed (or just failed to) while we waited for the lock
+        err = _cache["assets_error"]
+        if _cache["assets"]["ts"] >= requested or err["ts"] >= requested or (not force and _assets_fresh()):
+            return _cache["assets"]["data"]
+        now = time.monotonic()
+        try:
+            logger.info("Fetching market-lending-info from OKX")
+            # revalidate instead of re-downloading the full list when OKX sends ETag/Last-Modified
+            r = await _get(ALL_PAIRS_URL, headers=_cache["assets"]["validators"])
+            if r.status_code == 304:
+                logger.info("market-lending-info not modified")
+                _cache["assets"]["ts"] = now
+                err["ts"], err["backoff"] = 0.0, 0.0
+                return _cache["assets"]["data"]
+            items = [make_asset_view(a) for a in _parse_list(r)]
+        except Exception as e:
+            err["backoff"] = min(ERROR_BACKOFF_MAX, err["backoff"] * 2 or ERROR_BACKOFF_MIN)
+            err["ts"] = time.monotonic()
+            logger.exception("Failed to fetch assets (serving cached data for %.0fs): %s", err["backoff"], e)
+            return _cache["assets"]["data"]
         _cache["assets"]["data"] = items
+        _cache["assets"]["by_name"] = by_name = _index_assets(items)
+        _cache["assets"]["tickers_sorted"] = sorted(by_name)
         _cache["assets"]["ts"] = now
+        _cache["assets"]["version"] += 1
+        _cache["assets"]["validators"] = _validators(r)
+        err["ts"], err["backoff"] = 0.0, 0.0
         logger.info("Assets fetched: %d", len(items))
         return items
-    except Exception as e:
-        logger.exception("Failed to fetch assets: %s", e)
-        return _cache["assets"]["data"] or []
 
-def find_asset_by_ticker(ticker: str, assets: Optional[List[Dict[str, Any]]] = None) -> Optional[Dict[str, Any]]:
-    if assets is None:
-        assets = fetch_assets()
-    ticker = ticker.upper()
-    for a in assets:
-        name = (a.get("currencyName") or "").upper()
-        if name == ticker:
-            return a
-    return None
+def _asset_index(assets: Optional[List[AssetView]] = None) -> Dict[str, AssetView]:
+    """Name index for `assets`; the cached list reuses the index built at fetch time."""
+    if assets is None or assets is _cache["assets"]["data"]:
+        return _cache["assets"]["by_name"]
+    return _index_assets(assets)
+
+def find_asset_by_ticker(ticker: str, assets: Optional[List[AssetView]] = None) -> Optional[AssetView]:
+    return _asset_index(assets).get(ticker.upper())
 
-def fetch_history_entries(currency_id: int) -> List[Dict[str, Any]]:
-    headers = {"User-Agent": "Mozilla/5.0", "Accept": "application/json"}
-    url = HISTORY_URL_TEMPLATE.format(currency_id)
+async def _fetch_asset_by_id(ticker: str, currency_id: int) -> Optional[AssetView]:
     try:
-        logger.info("Fetching history for currencyId=%s", currency_id)
-        r = requests.get(url, headers=headers, timeout=10)
-        r.raise_for_status()
-        data = r.json()
-        items = data.get("data", {}).get("list", [])
-        if isinstance(items, dict):
-            items = [items]
-        logger.info("History entries: %d", len(items))
-        return items
+        logger.info("Fetching market-lending-info for currencyId=%s", currency_id)
+        for a in await _get_list(ASSET_URL_TEMPLATE.format(currency_id)):
+            if (a.get("currencyName") or "").upper() == ticker:
+                return make_asset_view(a)
     except Exception as e:
-        logger.exception("Failed to fetch history for %s: %s", currency_id, e)
-        return []
+        logger.exception("Failed to fetch asset %s: %s", ticker, e)
+    return None
 
+async def fetch_asset(ticker: str, force: bool = False) -> Optional[AssetView]:
+    """Look up one asset; on a stale cache or forced refresh, known tickers are
+    queried by currencyId instead of re-downloading the full list."""
+    ticker = ticker.upper()
+    cid = CURRENCY_IDS.get(ticker)
+    # during an error backoff, non-forced lookups use the stale list instead of asking OKX
+    if cid is not None and (force or not (_assets_fresh() or _in_error_backoff())):
+        task = _asset_inflight.get(ticker)
+        if task is None:
+            task = _asset_inflight[ticker] = asyncio.create_task(_fetch_asset_by_id(ticker, cid))
+            task.add_done_callback(lambda _: _asset_inflight.pop(ticker, None))
+        # shield: one caller giving up must not cancel the request for the others
+        asset = await asyncio.shield(task)
+        if asset:
+            return asset
+    assets = await fetch_assets(force=force)
+    return find_asset_by_ticker(ticker, assets)
+
+def _fresh_history(currency_id: int) -> Optional[List[Dict[str, Any]]]:
+    cached = _cache["history"].get(currency_id)
+    if cached and cached["data"] and (time.monotonic() - cached["ts"] < HISTORY_CACHE_TTL):
+        return cached["data"]
+    return None
+
+async def fetch_history_entries(currency_id: int) -> List[Dict[str, Any]]:
+    """Fetch (and cache per currency) market-lending-history entries.
+
+    Concurrent misses for the same currency share one request: later callers wait
+    on the per-currency lock and then find the cache filled.
+    """
+    data = _fresh_history(currency_id)
+    if data is not None:
+        return data
+
+    async with _history_locks.setdefault(currency_id, asyncio.Lock()):
+        data = _fresh_history(currency_id)
+        if data is not None:
+            return data
+        now = time.monotonic()
+        url = HISTORY_URL_TEMPLATE.format(currency_id, HISTORY_RECORDS)
+        try:
+            logger.info("Fetching history for currencyId=%s", currency_id)
+            items = await _get_list(url)
+            _cache["history"][currency_id] = {"ts": now, "data": items}
+            logger.info("History entries: %d", len(items))
+            return items
+        except Exception as e:
+            logger.exception("Failed to fetch history for %s: %s", currency_id, e)
+            cached = _cache["history"].get(currency_id)
+            return cached["data"] if cached else []
+
+async def _fetch_history_bounded(currency_id: int) -> List[Dict[str, Any]]:
+    async with _prefetch_sem:
+        return await fetch_history_entries(currency_id)
+
+async def prefetch_histories(tickers: List[str]) -> None:
+    """Warm the history cache for the given tickers concurrently."""
+    await asyncio.gather(*(_fetch_history_bounded(CURRENCY_IDS[t]) for t in tickers if t in CURRENCY_IDS))
+
+async def prefetch_all_histories() -> None:
+    """Warm the history cache for every supported currency (cache hits cost nothing)."""
+    await prefetch_histories(list(CURRENCY_IDS))
+
+async def background_refresh_assets() -> None:
+    """Keep the assets cache warm so handlers rarely wait on OKX."""
+    while True:
+        try:
+            await fetch_assets(force=True)
+        except Exception as e:
+            logger.exception("Background asset refresh failed: %s", e)
+        await asyncio.sleep(ASSET_REFRESH_INTERVAL)
+
+# dateHour values are hour-aligned and repeat across assets/refreshes, so memoize formatting;
+# time.gmtime avoids building a tz-aware datetime on each miss
+@lru_cache(maxsize=4096)
 def ms_to_utc_time(ms: int) -> str:
     try:
-        return datetime.fromtimestamp(ms / 1000, tz=timezone.utc).strftime("%H:%M UTC")
+        return time.strftime("%H:%M UTC", time.gmtime(ms / 1000))
     except Exception:
         return "N/A"
 
+@lru_cache(maxsize=4096)
 def ms_to_utc_dt(ms: int) -> str:
     try:
-        return datetime.fromtimestamp(ms / 1000, tz=timezone.utc).strftime("%Y-%m-%d %H:%M UTC")
+        return time.strftime("%Y-%m-%d %H:%M UTC", time.gmtime(ms / 1000))
     except Exception:
         return "N/A"
 
@@ -133,9 +356,62 @@ def safe_float(x) -> float:
     except Exception:
         return 0.0
 
+def sorted_pairs() -> Tuple[List[AssetView], List[str]]:
+    """Every cached asset sorted by current APR desc, plus the tickers in that order."""
+    d = _derived["pairs"]
+    if d["version"] != _cache["assets"]["version"]:
+        pairs = sorted((v for v in _cache["assets"]["data"] if v.name), key=_by_pre_pct, reverse=True)
+        d.update(version=_cache["assets"]["version"], rows=pairs, tickers=[v.name for v in pairs])
+    return d["rows"], d["tickers"]
+
+def history_records() -> List[AssetView]:
+    """Assets for the supported CURRENCY_IDS sorted by current APR desc."""
+    d = _derived["history"]
+    if d["version"] != _cache["assets"]["version"]:
+        idx = _asset_index()
+        records = [idx[t] for t in CURRENCY_IDS if t in idx]
+        records.sort(key=_by_pre_pct, reverse=True)
+        d.update(version=_cache["assets"]["version"], rows=records)
+    return d["rows"]
+
 # -------------------------
 # UI builders
 # -------------------------
+# Static keyboards are built once; InlineKeyboardMarkup is immutable in PTB v20
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📋 View All Pairs", callback_data="pairs_page_0")],
+    [InlineKeyboardButton("🔍 Search (ticker)", callback_data="search_prompt")],
+    [InlineKeyboardButton("📊 History", callback_data="history_page_0")],
+])
+
+HISTORY_DETAIL_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📋 View All Pairs", callback_data="pairs_page_0"),
+     InlineKeyboardButton("⬅ Back to History", callback_data="history_page_0")],
+    [InlineKeyboardButton("⬅ Back to Menu", callback_data="back_menu")],
+])
+
+@lru_cache(maxsize=256)
+def pair_markup(ticker: str, from_search: bool = False) -> InlineKeyboardMarkup:
+    """Keyboard under a single pair's rates; depends only on the ticker, so it is memoized."""
+    rows = [[InlineKeyboardButton("♻ Refresh", callback_data=f"refresh_{ticker}"),
+             InlineKeyboardButton("📊 History", callback_data=f"history_item_{ticker}")]]
+    if from_search:
+        rows.append([InlineKeyboardButton("📋 View All Pairs", callback_data="pairs_page_0")])
+    else:
+        rows.append([InlineKeyboardButton("⬅ Back to Pairs", callback_data="pairs_page_0"),
+                     InlineKeyboardButton("⬅ Back to Menu", callback_data="back_menu")])
+    return InlineKeyboardMarkup(rows)
+
+def cached_markup(key: tuple, build) -> InlineKeyboardMarkup:
+    """Return the markup for `key` built from the current asset snapshot, building it once."""
+    version = _cache["assets"]["version"]
+    if _kb_cache["version"] != version or len(_kb_cache["markups"]) >= KB_CACHE_MAX:
+        _kb_cache.update(version=version, markups={})
+    markup = _kb_cache["markups"].get(key)
+    if markup is None:
+        markup = _kb_cache["markups"][key] = build()
+    return markup
+
 def build_paginated_keyboard(items: List[str], page: int, prefix: str) -> InlineKeyboardMarkup:
     start = page * PAGE_SIZE
     chunk = items[start:start + PAGE_SIZE]
@@ -154,11 +430,10 @@ def build_paginated_keyboard(items: List[str], page: int, prefix: str) -> Inline
     ])
     return InlineKeyboardMarkup(keyboard)
 
-def build_history_menu_keyboard(records: List[tuple], page: int) -> InlineKeyboardMarkup:
-    # records: list of (ticker, apr_float, hhmm)
+def build_history_menu_keyboard(records: List[AssetView], page: int) -> InlineKeyboardMarkup:
     start = page * PAGE_SIZE
     chunk = records[start:start + PAGE_SIZE]
-    keyboard = [[InlineKeyboardButton(f"{t} — {apr:.2f}% ({hh})", callback_data=f"history_item_{t}")] for t, apr, hh in chunk]
+    keyboard = [[InlineKeyboardButton(f"{v.name} — {v.pre_pct:.2f}% ({v.hhmm})", callback_data=f"history_item_{v.name}")] for v in chunk]
     nav = []
     if start > 0:
         nav.append(InlineKeyboardButton("⬅ Prev", callback_data=f"history_page_{page-1}"))
@@ -169,342 +444,298 @@ def build_history_menu_keyboard(records: List[tuple], page: int) -> InlineKeyboa
     keyboard.append(nav)
     return InlineKeyboardMarkup(keyboard)
 
+def build_filtered_page(filtered: List[str], page: int, search: str) -> Tuple[str, InlineKeyboardMarkup]:
+    idx = _asset_index()
+    start = page * PAGE_SIZE
+    lines = []
+    for t in filtered[start:start + PAGE_SIZE]:
+        asset = idx.get(t)
+        if asset:
+            lines.append(f"{t} — {asset.pre_pct:.2f}% ({asset.hhmm})")
+    text = f"Search results for '{search}':\n\n" + ("\n".join(lines) if lines else "No matches.")
+    return text, build_paginated_keyboard(filtered, page, prefix="pairs_filtered")
+
+async def render_pair(ticker: str, force: bool = False, from_search: bool = False) -> Optional[Tuple[str, InlineKeyboardMarkup]]:
+    """Current rate view shared by search, pair and refresh; None if ticker is unknown."""
+    asset = await fetch_asset(ticker, force=force)
+    if not asset:
+        return None
+    text = (
+        f"♻ {ticker} Lending Rates at {asset.dt_str}\n"
+        f"💰 Current rate: {asset.pre_pct:.2f}%\n"
+        f"📈 Predicted rate: {asset.est_pct:.2f}%"
+    )
+    return text, pair_markup(ticker, from_search=from_search)
+
 # -------------------------
 # Handlers
 # -------------------------
 async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     logger.info("User %s started bot", user.id if user else "unknown")
-    kb = [
-        [InlineKeyboardButton("📋 View All Pairs", callback_data="pairs_page_0")],
-        [InlineKeyboardButton("🔍 Search (ticker)", callback_data="search_prompt")],
-        [InlineKeyboardButton("📊 History", callback_data="history_page_0")],
-    ]
-    await update.message.reply_text("Welcome — choose an option:", reply_markup=InlineKeyboardMarkup(kb))
+    await update.message.reply_text("Welcome — choose an option:", reply_markup=MAIN_MENU_MARKUP)
 
 # ---- Search conversation ----
 async def search_prompt_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    context.user_data["awaiting_search"] = True
     logger.info("User %s prompted to search ticker", update.effective_user.id)
     await query.edit_message_text("Enter ticker (e.g. TON):")
     return SEARCH_INPUT
 
 async def search_input_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip().upper()
-    context.user_data["awaiting_search"] = False
     logger.info("User %s searching ticker %s", update.effective_user.id, text)
-    assets = fetch_assets(force=True)
-    asset = find_asset_by_ticker(text, assets)
-    if not asset:
+    view = await render_pair(text, from_search=True)
+    if not view:
         await update.message.reply_text(f"❌ Ticker {text} not found.")
         return ConversationHandler.END
-
-    pre = safe_float(asset.get("preRate", 0)) * 100
-    est = safe_float(asset.get("estimatedRate", 0)) * 100
-    ts = asset.get("dateHour") or asset.get("dateHourStr")
-    # prefer numeric ms timestamp
-    last_time = ms_to_utc_dt(asset.get("dateHour")) if asset.get("dateHour") else "N/A"
-    msg = (
-        f"♻ {text} Lending Rates at {last_time}\n"
-        f"💰 Current rate: {pre:.2f}%\n"
-        f"📈 Predicted rate: {est:.2f}%"
-    )
-    kb = [
-        [InlineKeyboardButton("♻ Refresh", callback_data=f"refresh_{text}"),
-         InlineKeyboardButton("📊 History", callback_data=f"history_item_{text}")],
-        [InlineKeyboardButton("📋 View All Pairs", callback_data="pairs_page_0")]
-    ]
-    await update.message.reply_text(msg, reply_markup=InlineKeyboardMarkup(kb))
+    msg, markup = view
+    await update.message.reply_text(msg, reply_markup=markup)
     return ConversationHandler.END
 
 # ---- View All Pairs ----
-async def pairs_page_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def pairs_page_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
     query = update.callback_query
     await query.answer()
-    # callback format pairs_page_{n}
-    try:
-        page = int(query.data.split("_")[-1])
-    except Exception:
-        page = 0
-    assets = fetch_assets()
-    # create sorted tickers by preRate descending
-    pairs = []
-    for a in assets:
-        name = (a.get("currencyName") or "").upper()
-        pre = safe_float(a.get("preRate", 0)) * 100
-        dt = a.get("dateHour', None")  if False else a.get("dateHour")  # placeholder safe access
-        # use dateHour if available
-        time_str = ms_to_utc_time(a.get("dateHour")) if a.get("dateHour") else "N/A"
-        pairs.append((name, pre, time_str))
-    # remove empty names and sort
-    pairs = [p for p in pairs if p[0]]
-    pairs.sort(key=lambda x: x[1], reverse=True)
-
-    tickers = [f"{name}" for name, _, _ in pairs]
-    reply_markup = build_paginated_keyboard(tickers, page, prefix="pairs")
-    # Build text for this page
+    # callback format pairs_page_{n}; the route pattern only matches digits
+    page = int(arg)
+    await fetch_assets()
+    # every page slices the sorted view, which is built once per data version
+    pairs, tickers = sorted_pairs()
+    reply_markup = cached_markup(("pairs", page), lambda: build_paginated_keyboard(tickers, page, prefix="pairs"))
     start = page * PAGE_SIZE
     page_chunk = pairs[start:start + PAGE_SIZE]
-    lines = [f"{n} — {apr:.2f}% ({t})" for n, apr, t in page_chunk]
+    lines = [f"{v.name} — {v.pre_pct:.2f}% ({v.hhmm})" for v in page_chunk]
     text = "📋 All Pairs (sorted by current APR desc)\n\n" + ("\n".join(lines) if lines else "No pairs found.")
     await query.edit_message_text(text, reply_markup=reply_markup)
 
 # ---- Pair selected from pairs list ----
-async def pairs_item_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def pairs_item_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
     query = update.callback_query
     await query.answer()
-    # callback format pairs_item_{TICKER}
-    try:
-        ticker = query.data.split("_", 2)[2].upper()
-    except Exception:
-        await query.edit_message_text("Invalid pair selection.")
-        return
-    assets = fetch_assets()
-    asset = find_asset_by_ticker(ticker, assets)
-    if not asset:
+    # callback format pairs_item_{TICKER} (or legacy pair_{TICKER}); the route pattern captures TICKER
+    ticker = arg.upper()
+    view = await render_pair(ticker)
+    if not view:
         await query.edit_message_text(f"Ticker {ticker} not found.")
         return
-    pre = safe_float(asset.get("preRate", 0)) * 100
-    est = safe_float(asset.get("estimatedRate", 0)) * 100
-    last_time = ms_to_utc_dt(asset.get("dateHour")) if asset.get("dateHour") else "N/A"
-    msg = (
-        f"♻ {ticker} Lending Rates at {last_time}\n"
-        f"💰 Current rate: {pre:.2f}%\n"
-        f"📈 Predicted rate: {est:.2f}%"
-    )
-    kb = [
-        [InlineKeyboardButton("♻ Refresh", callback_data=f"refresh_{ticker}"),
-         InlineKeyboardButton("📊 History", callback_data=f"history_item_{ticker}")],
-        [InlineKeyboardButton("⬅ Back to Pairs", callback_data="pairs_page_0"),
-         InlineKeyboardButton("⬅ Back to Menu", callback_data="back_menu")]
-    ]
-    await query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(kb))
+    msg, markup = view
+    await query.edit_message_text(msg, reply_markup=markup)
 
 # ---- Refresh handler ----
-async def refresh_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+def _refresh_allowed(user_id: int, ticker: str) -> bool:
+    """False if this user refreshed this ticker less than REFRESH_COOLDOWN ago."""
+    now = time.monotonic()
+    key = (user_id, ticker)
+    last = _last_refresh.get(key)
+    if last is not None and now - last < REFRESH_COOLDOWN:
+        return False
+    if len(_last_refresh) >= REFRESH_COOLDOWN_PRUNE_AT:
+        for k in [k for k, ts in _last_refresh.items() if now - ts >= REFRESH_COOLDOWN]:
+            del _last_refresh[k]
+    _last_refresh[key] = now
+    return True
+
+async def refresh_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
     query = update.callback_query
-    await query.answer()
-    try:
-        ticker = query.data.split("_", 1)[1].upper()
-    except Exception:
-        await query.edit_message_text("Invalid refresh request.")
+    ticker = arg.upper()
+    # repeated taps would each cost an OKX request and a message edit; drop them early
+    if not _refresh_allowed(query.from_user.id, ticker):
+        await query.answer("Please wait…")
         return
-    assets = fetch_assets(force=True)
-    asset = find_asset_by_ticker(ticker, assets)
-    if not asset:
+    await query.answer()
+    view = await render_pair(ticker, force=True)
+    if not view:
         await query.edit_message_text(f"Ticker {ticker} not found.")
         return
-    pre = safe_float(asset.get("preRate", 0)) * 100
-    est = safe_float(asset.get("estimatedRate", 0)) * 100
-    last_time = ms_to_utc_dt(asset.get("dateHour")) if asset.get("dateHour") else "N/A"
-    msg = (
-        f"♻ {ticker} Lending Rates at {last_time}\n"
-        f"💰 Current rate: {pre:.2f}%\n"
-        f"📈 Predicted rate: {est:.2f}%"
-    )
-    kb = [
-        [InlineKeyboardButton("♻ Refresh", callback_data=f"refresh_{ticker}"),
-         InlineKeyboardButton("📊 History", callback_data=f"history_item_{ticker}")],
-        [InlineKeyboardButton("⬅ Back to Pairs", callback_data="pairs_page_0"),
-         InlineKeyboardButton("⬅ Back to Menu", callback_data="back_menu")]
-    ]
-    await query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(kb))
+    msg, markup = view
+    await query.edit_message_text(msg, reply_markup=markup)
 
 # ---- History menu (only supported CURRENCY_IDS, sorted by latest APR desc) ----
-async def history_menu_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def history_menu_page(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
     query = update.callback_query
     await query.answer()
-    try:
-        page = int(query.data.split("_")[-1])
-    except Exception:
-        page = 0
-    assets = fetch_assets()
-    records = []
-    for ticker, cid in CURRENCY_IDS.items():
-        asset = find_asset_by_ticker(ticker, assets)
-        if not asset:
-            continue
-        pre = safe_float(asset.get("preRate", 0)) * 100
-        hh = ms_to_utc_time(asset.get("dateHour")) if asset.get("dateHour") else "N/A"
-        records.append((ticker, pre, hh))
-    records.sort(key=lambda x: x[1], reverse=True)
-    reply_markup = build_history_menu_keyboard(records, page)
+    page = int(arg)
+    await fetch_assets()
+    records = history_records()
+    reply_markup = cached_markup(("history", page), lambda: build_history_menu_keyboard(records, page))
     # build text page
     start = page * PAGE_SIZE
     chunk = records[start:start + PAGE_SIZE]
-    lines = [f"{t} — {apr:.2f}% ({hh})" for t, apr, hh in chunk]
+    lines = [f"{v.name} — {v.pre_pct:.2f}% ({v.hhmm})" for v in chunk]
     text = "📊 History (supported pairs) — latest APR\n\n" + ("\n".join(lines) if lines else "No records.")
     await query.edit_message_text(text, reply_markup=reply_markup)
+    # warm history for all supported tickers so any detail view opens from cache
+    context.application.create_task(prefetch_all_histories())
 
 # ---- History item detail: last 24 hours + average APR for today (UTC) ----
-async def history_item_detail(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def history_item_detail(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
     query = update.callback_query
     await query.answer()
-    try:
-        ticker = query.data.split("_", 2)[2].upper()
-    except Exception:
-        await query.edit_message_text("Invalid history selection.")
-        return
+    ticker = arg.upper()
     cid = CURRENCY_IDS.get(ticker)
     if not cid:
         await query.edit_message_text(f"{ticker} is not supported for history.")
         return
-    entries = fetch_history_entries(cid)
+    entries = await fetch_history_entries(cid)
     if not entries:
         await query.edit_message_text(f"No history data for {ticker}.")
         return
 
-    # take newest 24 entries
-    last24 = entries[:24]
-    now_date = datetime.now(timezone.utc).date()
-    today_rates = []
+    # take newest HISTORY_RECORDS entries
+    last24 = entries[:HISTORY_RECORDS]
+    now = datetime.now(timezone.utc)
+    now_date = now.date()
+    # UTC days are whole multiples of DAY_MS since the epoch, so "today" is an int range
+    now_ms = int(now.timestamp() * 1000)
+    today_ms_start = now_ms - now_ms % DAY_MS
+    today_ms_end = today_ms_start + DAY_MS
+    sum_today = 0.0
+    count_today = 0
     lines = []
+    append = lines.append
+    fmt = "{} — {:.2f}%".format
+    # single pass: each entry's rate and timestamp are read once, for both the line and the average
     for e in last24:
         rate_pct = safe_float(e.get("rate", 0)) * 100
-        dt = ms_to_utc_dt(e.get("dateHour")) if e.get("dateHour") else "N/A"
-        lines.append(f"{dt} — {rate_pct:.2f}%")
-        try:
-            d_obj = datetime.fromtimestamp(e.get("dateHour") / 1000, tz=timezone.utc).date()
-            if d_obj == now_date:
-                today_rates.append(rate_pct)
-        except Exception:
-            pass
-
-    avg_today = sum(today_rates) / len(today_rates) if today_rates else 0.0
+        ms = e.get("dateHour")
+        append(fmt(ms_to_utc_dt(ms) if ms else "N/A", rate_pct))
+        if isinstance(ms, (int, float)) and today_ms_start <= ms < today_ms_end:
+            sum_today += rate_pct
+            count_today += 1
+    avg_today = sum_today / count_today if count_today else 0.0
     header = f"📊 {ticker} Lending Rate — Last {len(last24)} records\n\n📌 Average APR for {now_date.isoformat()} (UTC): {avg_today:.2f}%\n\n"
     text = header + "\n".join(lines)
-    kb = [
-        [InlineKeyboardButton("📋 View All Pairs", callback_data="pairs_page_0"),
-         InlineKeyboardButton("⬅ Back to History", callback_data="history_page_0")],
-        [InlineKeyboardButton("⬅ Back to Menu", callback_data="back_menu")]
-    ]
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
+    await query.edit_message_text(text, reply_markup=HISTORY_DETAIL_MARKUP)
 
 # ---- Back to menu ----
 async def back_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    kb = [
-        [InlineKeyboardButton("📋 View All Pairs", callback_data="pairs_page_0")],
-        [InlineKeyboardButton("🔍 Search (ticker)", callback_data="search_prompt")],
-        [InlineKeyboardButton("📊 History", callback_data="history_page_0")]
-    ]
-    await query.edit_message_text("Main menu:", reply_markup=InlineKeyboardMarkup(kb))
+    await query.edit_message_text("Main menu:", reply_markup=MAIN_MENU_MARKUP)
 
 # ---- Pairs search (filter) flow ----
 async def pairs_search_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    context.user_data["awaiting_pairs_search"] = True
     await query.edit_message_text("Enter substring to search pairs (e.g. 'ETH' or 'US'):")
     return PAIRS_FILTER_INPUT
 
 async def pairs_search_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip().upper()
-    context.user_data["awaiting_pairs_search"] = False
-    assets = fetch_assets()
-    tickers = sorted({(a.get("currencyName") or "").upper() for a in assets if a.get("currencyName")})
-    filtered = [t for t in tickers if text in t]
+    await fetch_assets()
+    filtered = [t for t in _cache["assets"]["tickers_sorted"] if text in t]
     if not filtered:
         await update.message.reply_text(f"No pairs match '{text}'.")
         return ConversationHandler.END
     # store filtered list in user_data for pagination
     context.user_data["pairs_filtered"] = filtered
-    # send first page of filtered results
-    markup = build_paginated_keyboard(filtered, 0, prefix="pairs_filtered")
-    # build text for first page
-    lines = []
-    for t in filtered[:PAGE_SIZE]:
-        asset = find_asset_by_ticker(t, assets)
-        if asset:
-            apr = safe_float(asset.get("preRate", 0)) * 100
-            dt = ms_to_utc_time(asset.get("dateHour")) if asset.get("dateHour") else "N/A"
-            lines.append(f"{t} — {apr:.2f}% ({dt})")
-    text = f"Search results for '{text}':\n\n" + ("\n".join(lines) if lines else "No matches.")
+    context.user_data["pairs_filter_text"] = text
+    text, markup = build_filtered_page(filtered, 0, text)
     await update.message.reply_text(text, reply_markup=markup)
     return ConversationHandler.END
 
-# ---- Generic callback router ----
-async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# ---- Filtered pairs keyboard: pairs_filtered_page_{n} / pairs_filtered_item_{TICKER} ----
+async def pairs_filtered_page_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    query = update.callback_query
+    await query.answer()
+    page = int(arg)
+    filtered = context.user_data.get("pairs_filtered")
+    if not filtered:
+        await query.edit_message_text("Search expired — use 🔍 Search Pairs again.", reply_markup=MAIN_MENU_MARKUP)
+        return
+    await fetch_assets()
+    text, markup = build_filtered_page(filtered, page, context.user_data.get("pairs_filter_text", ""))
+    await query.edit_message_text(text, reply_markup=markup)
+
+# ---- Callback routes ----
+# callback_data is either an exact route or "<route>_<arg>"; PTB matches the patterns and the
+# handler gets <arg>. 'pair_{TICKER}' and 'history_{TICKER}' are older patterns kept for old
+# messages. search_prompt / pairs_search are the conversation entry points registered in main().
+# Page routes only accept digits, so handlers can int() the arg directly.
+CALLBACK_ROUTES = tuple((re.compile(pattern), handler) for pattern, handler in (
+    (r"^back_menu$", back_menu_handler),
+    (r"^pairs_page_(\d+)$", pairs_page_handler),
+    (r"^pairs_item_(.+)$", pairs_item_handler),
+    (r"^pairs_filtered_page_(\d+)$", pairs_filtered_page_handler),
+    (r"^pairs_filtered_item_(.+)$", pairs_item_handler),
+    (r"^pair_(.+)$", pairs_item_handler),
+    (r"^refresh_(.+)$", refresh_handler),
+    (r"^history_page_(\d+)$", history_menu_page),
+    (r"^history_item_(.+)$", history_item_detail),
+    (r"^history_(?!page_|item_)(.+)$", history_item_detail),
+))
+
+def _route(handler):
+    """Adapt a route handler for PTB: the pattern's groups are passed as its arguments."""
+    async def callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        logger.info("Callback data received: %s from user %s", update.callback_query.data,
+                    update.effective_user.id if update.effective_user else None)
+        return await handler(update, context, *context.match.groups())
+    return callback
+
+async def unknown_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    data = (query.data or "")
-    logger.info("Callback data received: %s from user %s", data, update.effective_user.id if update.effective_user else None)
-
-    # pairs pages and items
-    if data.startswith("pairs_page_"):
-        return await pairs_page_handler(update, context)
-    if data.startswith("pairs_item_") or data.startswith("pairs_item_"):  # kept for clarity
-        return await pairs_item_handler(update, context)
-    if data.startswith("pairs_item_") is False and data.startswith("pairs_item_") is False:
-        pass
-
-    if data.startswith("pairs_item_"):
-        return await pairs_item_handler(update, context)
-    # generic "pairs" items built with prefix 'pairs_item_' in build_paginated_keyboard; but we used 'pairs_item_{TICKER}'
-    if data.startswith("pairs_item_") or data.startswith("pairs_item_"):
-        return await pairs_item_handler(update, context)
-
-    # filtered pairs pagination (prefix 'pairs_page_' used for both full and filtered; for filtered we check user_data)
-    if data.startswith("pairs_page_"):
-        # reuse pairs_page_handler but it will display full list page; for filtered we support different prefix in build if desired
-        return await pairs_page_handler(update, context)
-
-    # handle pair selection from paginated keyboard: prefix 'pairs_item_{TICKER}'
-    if data.startswith("pairs_item_"):
-        return await pairs_item_handler(update, context)
-
-    # refresh
-    if data.startswith("refresh_"):
-        return await refresh_handler(update, context)
-
-    # search prompt
-    if data == "search_prompt":
-        return await search_prompt_cb(update, context)
-
-    # pairs filter search start
-    if data == "pairs_search":
-        return await pairs_search_prompt(update, context)
-
-    # direct pair selection callback pattern 'pair_{TICKER}' (older patterns)
-    if data.startswith("pair_"):
-        # convert to "pairs_item" handling; create a temporary query.data to expected value
-        query.data = f"pairs_item_{data.split('_',1)[1]}"
-        return await pairs_item_handler(update, context)
-
-    # history menu pages
-    if data.startswith("history_page_"):
-        return await history_menu_page(update, context)
-    # history item selected
-    if data.startswith("history_item_"):
-        return await history_item_detail(update, context)
-    # history item produced originally as 'history_item_{TICKER}'
-    if data.startswith("history_item_"):
-        return await history_item_detail(update, context)
-
-    # history item older pattern 'history_{TICKER}'
-    if data.startswith("history_") and not data.startswith("history_item_"):
-        # convert
-        parts = data.split("_", 1)
-        if len(parts) == 2:
-            ticker = parts[1]
-            query.data = f"history_item_{ticker}"
-            return await history_item_detail(update, context)
-
-    # back to menu
-    if data == "back_menu":
-        return await back_menu_handler(update, context)
-
-    # fallback
     await query.answer("Unknown action", show_alert=True)
-    logger.warning("Unhandled callback data: %s", data)
+    logger.warning("Unhandled callback data: %s", query.data)
 
 # -------------------------
 # Setup and run
 # -------------------------
+async def post_init(app: Application):
+    global _http, _refresh_task, _prefetch_sem, _okx_sem, _assets_lock
+    _prefetch_sem = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+    _okx_sem = asyncio.Semaphore(OKX_CONCURRENCY)
+    _assets_lock = asyncio.Lock()
+    _http = httpx.AsyncClient(
+        headers=HTTP_HEADERS,
+        timeout=10,
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,  # multiplex concurrent OKX requests over one connection
+            retries=2,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=20, keepalive_expiry=60),
+        ),
+    )
+    _refresh_task = asyncio.create_task(background_refresh_assets())
+
+async def post_shutdown(app: Application):
+    if _refresh_task is not None:
+        _refresh_task.cancel()
+    if _http is not None:
+        await _http.aclose()
+
 def main():
-    app = Application.builder().token(BOT_TOKEN).build()
+    # uvloop is optional (not available on Windows); fall back to the stdlib loop
+    try:
+        import uvloop
+        # same effect as uvloop.install(), which is deprecated from Python 3.12
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        logger.info("Using uvloop event loop")
+    except ImportError:
+        pass
+
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        # handlers run concurrently (block=False): keep PTB's default bot API pool (256),
+        # bound the waits, and keep long polling on its own small pool
+        .pool_timeout(20)
+        .connect_timeout(10)
+        .read_timeout(20)
+        .get_updates_connection_pool_size(4)
+        .get_updates_pool_timeout(60)
+        # pace outgoing calls just under Telegram's limits (30/s overall, 20/min per group)
+        # instead of tripping RetryAfter and stalling everyone
+        .rate_limiter(AIORateLimiter(
+            overall_max_rate=25, overall_time_period=1,
+            group_max_rate=18, group_time_period=60,
+            max_retries=3,
+        ))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Conversation for search ticker
     search_conv = ConversationHandler(
@@ -522,12 +753,16 @@ def main():
         allow_reentry=True,
     )
 
-    app.add_handler(CommandHandler("start", start_handler))
+    # Stand-alone handlers run as tasks (block=False) so a slow OKX call doesn't hold up
+    # other users' updates; conversation steps stay blocking to keep state changes ordered.
+    app.add_handler(CommandHandler("start", start_handler, block=False))
     app.add_handler(search_conv)
     app.add_handler(pairs_search_conv)
-    app.add_handler(CallbackQueryHandler(callback_router))
+    for pattern, handler in CALLBACK_ROUTES:
+        app.add_handler(CallbackQueryHandler(_route(handler), pattern=pattern, block=False))
+    app.add_handler(CallbackQueryHandler(unknown_callback, block=False))
     # direct text as quick ticker lookup (if user just types ticker)
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, search_input_handler))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, search_input_handler, block=False))
 
     logger.info("Bot starting polling...")
     app.run_polling()